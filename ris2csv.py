@@ -2,13 +2,49 @@ import csv
 import re
 import os
 import glob
+import hashlib
+import random
+import string
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
 
+# Buffer size used for all file I/O (1 MB instead of the 8 KB default)
+_BUFFER_SIZE = 1 << 20
+
+# Characters allowed in a two-character RIS tag
+_TAG_CHARS = frozenset(string.ascii_uppercase + string.digits)
+
+# An ER line, which ends a reference (matched together with the preceding newline)
+_RECORD_END_RE = re.compile(r'\n[^\S\n]*ER[^\n]*')
+
+# Fallback for tag lines that don't use the canonical "XX  - " layout
+_TAG_LINE_RE = re.compile(r'([A-Z0-9]{2})\s*-\s*(.*)')
+
+# Near-duplicate detection (--fuzzy): MinHash signatures over character
+# 5-grams of the identifying fields, bucketed by LSH bands. Candidates from
+# the buckets are confirmed against the estimated Jaccard similarity.
+_FUZZY_FIELDS = ('TY', 'TI', 'T1', 'AU', 'PY')
+# A row is only checked when one of these has text; TY and PY alone are too
+# generic and would make unrelated untitled references look identical
+_FUZZY_IDENTIFYING_FIELDS = ('TI', 'T1', 'AU')
+_FUZZY_THRESHOLD = 0.85
+_SHINGLE_SIZE = 5
+_MINHASH_PERMUTATIONS = 64
+_LSH_BANDS = 8
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(0)
+_MINHASH_COEFFS = tuple((_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(_MERSENNE_PRIME))
+                        for _ in range(_MINHASH_PERMUTATIONS))
+del _rng
+
 def load_ris_standards(standards_file):
     """Load RIS standards from CSV file."""
     standards = {}
     try:
-        with open(standards_file, 'r', encoding='utf-8-sig') as f:
+        with open(standards_file, 'r', encoding='utf-8-sig', buffering=_BUFFER_SIZE) as f:
             reader = csv.reader(f)
             for i, row in enumerate(reader, 1):
                 if not row or len(row) < 2:
@@ -33,158 +69,246 @@ def load_ris_standards(standards_file):
         print(f"Error loading {standards_file}: {e}")
         raise
 
+@lru_cache(maxsize=None)
+def _standards_bundle(standards_file):
+    """Load RIS standards once per file and cache the derived field lists."""
+    standards = load_ris_standards(standards_file)
+    fields = tuple(sorted(standards.keys()))
+    
+    # Identify multi-value fields based on notes in RIS_stds.csv
+    multi_value_fields = frozenset(tag for tag, info in standards.items()
+                                   if 'each' in info['notes'].lower() and 'line' in info['notes'].lower())
+    return standards, fields, multi_value_fields
+
+def _minhash_signature(text):
+    """Return the MinHash signature of the normalized text, or None if it is empty."""
+    text = ' '.join(re.findall(r'\w+', text.lower()))
+    if not text:
+        return None
+    shingles = {text[i:i + _SHINGLE_SIZE] for i in range(max(len(text) - _SHINGLE_SIZE + 1, 1))}
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little')
+              for s in shingles]
+    return tuple(min([(a * h + b) % _MERSENNE_PRIME for h in hashes]) for a, b in _MINHASH_COEFFS)
+
+def _is_near_duplicate(signature, buckets, signatures):
+    """Check a signature against the LSH buckets, adding it if it is new."""
+    rows = _MINHASH_PERMUTATIONS // _LSH_BANDS
+    bands = [(band, signature[band * rows:(band + 1) * rows]) for band in range(_LSH_BANDS)]
+    
+    checked = set()
+    for key in bands:
+        for candidate in buckets.get(key, ()):
+            if candidate in checked:
+                continue
+            checked.add(candidate)
+            other = signatures[candidate]
+            matches = sum(1 for x, y in zip(signature, other) if x == y)
+            if matches >= _FUZZY_THRESHOLD * _MINHASH_PERMUTATIONS:
+                return True
+    
+    signatures.append(signature)
+    for key in bands:
+        buckets.setdefault(key, []).append(len(signatures) - 1)
+    return False
+
 def parse_ris_file(ris_file):
     """Parse RIS file and return list of references."""
     references = []
     current_ref = {}
     
-    with open(ris_file, 'r', encoding='utf-8-sig') as f:
-        lines = f.readlines()
+    with open(ris_file, 'r', encoding='utf-8-sig', buffering=_BUFFER_SIZE) as f:
+        text = f.read()
     
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
+    # Split the text at ER lines in a single scan; the leading newline lets an
+    # ER on the very first line match as well
+    for chunk in _RECORD_END_RE.split('\n' + text):
+        for line in chunk.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
             
-        if line.startswith('ER'):
-            if current_ref and 'TY' in current_ref:
-                references.append(current_ref)
-                current_ref = {}
-            continue
+            # Fast path: canonical "XX  - value" lines are parsed by slicing
+            if line[2:5] == '  -' and line[0] in _TAG_CHARS and line[1] in _TAG_CHARS:
+                tag = line[:2]
+                value = line[5:].lstrip()
+            else:
+                match = _TAG_LINE_RE.match(line)
+                if not match:
+                    continue
+                tag, value = match.groups()
+                value = value.strip()
             
-        match = re.match(r'^([A-Z0-9]{2})\s*-\s*(.*)$', line)
-        if match:
-            tag, value = match.groups()
-            value = value.strip()
             if value or tag == 'TY':
-                if tag in current_ref:
-                    if isinstance(current_ref[tag], list):
-                        current_ref[tag].append(value)
-                    else:
-                        current_ref[tag] = [current_ref[tag], value]
-                else:
+                # Most tags occur once; only a repeated tag is promoted to a list
+                prev = current_ref.get(tag)
+                if prev is None:
                     current_ref[tag] = value
-    
-    if current_ref and 'TY' in current_ref:
-        references.append(current_ref)
+                elif type(prev) is list:
+                    prev.append(value)
+                else:
+                    current_ref[tag] = [prev, value]
+        
+        if current_ref and 'TY' in current_ref:
+            references.append(current_ref)
+            current_ref = {}
     
     return references
 
-def convert_ris_to_csv(ris_file, standards_file, output_csv):
-    """Convert a single RIS file to CSV."""
+def convert_ris_to_csv(ris_file, fields, output_csv):
+    """Convert a single RIS file to CSV using the preloaded standard fields."""
     try:
-        standards = load_ris_standards(standards_file)
         references = parse_ris_file(ris_file)
         
-        fields = sorted(standards.keys())
         print(f"CSV header fields for {output_csv}: {fields}")
         
-        with open(output_csv, 'w', encoding='utf-8', newline='') as f:
+        # The header is written from fields, which always contains TY
+        ty_index = fields.index('TY')
+        missing_ty = []
+        
+        with open(output_csv, 'w', encoding='utf-8', newline='', buffering=_BUFFER_SIZE) as f:
             writer = csv.writer(f)
             writer.writerow(fields)
             
-            for ref in references:
+            for i, ref in enumerate(references, 1):
                 row = []
                 for field in fields:
                     value = ref.get(field, '')
                     if isinstance(value, list):
                         value = ';'.join(str(v) for v in value)
                     row.append(value)
-                writer.writerow(row)
+                
+                # Fast path: rows without commas, quotes or line breaks need no
+                # quoting, so join them directly with csv.writer's line ending
+                line = ','.join(row)
+                if ('"' in line or '\n' in line or '\r' in line
+                        or line.count(',') != len(row) - 1):
+                    writer.writerow(row)
+                else:
+                    f.write(line + '\r\n')
+                if not row[ty_index]:
+                    missing_ty.append(i)
         
-        # Validate output
-        with open(output_csv, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            if 'TY' not in reader.fieldnames:
-                print(f"Error: 'TY' field missing in CSV header of {output_csv}")
-                return
-            for i, row in enumerate(reader, 1):
-                if not row['TY']:
-                    print(f"Warning: Missing TY field value in reference {i} of {output_csv}")
+        for i in missing_ty:
+            print(f"Warning: Missing TY field value in reference {i} of {output_csv}")
         
         print(f"Converted {ris_file} to {output_csv}")
     
     except Exception as e:
         print(f"Error converting {ris_file} to {output_csv}: {e}")
 
-def merge_csv_files(csv_folder, merged_output_csv, standards_file):
-    """Merge all CSV files in the folder into a single CSV, removing duplicates."""
+def merge_csv_files(csv_folder, merged_output_csv, fields, fuzzy=False):
+    """Merge all CSV files in the folder into a single CSV, removing duplicates.
+    
+    With fuzzy=True, rows whose type, title, authors and year are nearly
+    identical to an already merged row are dropped as well.
+    """
     try:
-        standards = load_ris_standards(standards_file)
-        fields = sorted(standards.keys())
-        
-        unique_rows = set()
-        header_written = False
+        fields_set = frozenset(fields)
         
         csv_files = glob.glob(os.path.join(csv_folder, "*.csv"))
         if not csv_files:
             print(f"No CSV files found in {csv_folder}")
             return
         
-        for csv_file in csv_files:
-            if csv_file == merged_output_csv:
-                continue
-            with open(csv_file, 'r', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                header = next(reader)
-                if sorted(header) != fields:
-                    print(f"Warning: Header mismatch in {csv_file}. Expected: {fields}, Got: {header}")
-                    continue
-                for row in reader:
-                    row_tuple = tuple(row)
-                    unique_rows.add(row_tuple)
+        # Only a 128-bit digest of each row is kept, and rows are written as soon
+        # as they are first seen, so memory no longer grows with the row contents
+        seen = set()
+        buckets = {}
+        signatures = []
+        near_duplicates = 0
         
-        with open(merged_output_csv, 'w', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f)
+        with open(merged_output_csv, 'w', encoding='utf-8', newline='', buffering=_BUFFER_SIZE) as out_f:
+            writer = csv.writer(out_f)
             writer.writerow(fields)
-            for row in unique_rows:
-                writer.writerow(row)
+            
+            for csv_file in csv_files:
+                if csv_file == merged_output_csv:
+                    continue
+                with open(csv_file, 'r', encoding='utf-8', buffering=_BUFFER_SIZE) as f:
+                    reader = csv.reader(f)
+                    header = next(reader)
+                    if len(header) != len(fields) or frozenset(header) != fields_set:
+                        print(f"Warning: Header mismatch in {csv_file}. Expected: {fields}, Got: {header}")
+                        continue
+                    fuzzy_columns = [header.index(field) for field in _FUZZY_FIELDS if field in header]
+                    identifying_columns = [header.index(field) for field in _FUZZY_IDENTIFYING_FIELDS
+                                           if field in header]
+                    for row in reader:
+                        # repr() quotes every field, so distinct rows never share a key
+                        key = hashlib.blake2b(repr(row).encode('utf-8'), digest_size=16).digest()
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        if fuzzy and any(i < len(row) and re.search(r'\w', row[i]) for i in identifying_columns):
+                            signature = _minhash_signature(' '.join(row[i] if i < len(row) else ''
+                                                                    for i in fuzzy_columns))
+                            if _is_near_duplicate(signature, buckets, signatures):
+                                near_duplicates += 1
+                                continue
+                        writer.writerow(row)
         
-        print(f"Merged {len(csv_files)} CSV files into {merged_output_csv} with {len(unique_rows)} unique rows")
+        unique_rows = len(seen) - near_duplicates
+        print(f"Merged {len(csv_files)} CSV files into {merged_output_csv} with {unique_rows} unique rows")
+        if fuzzy:
+            print(f"Dropped {near_duplicates} near-duplicate rows")
     
     except Exception as e:
         print(f"Error merging CSV files into {merged_output_csv}: {e}")
 
-def convert_csv_to_ris(csv_file, standards_file, output_ris):
+def convert_csv_to_ris(csv_file, fields, multi_value_fields, output_ris):
     """Convert a CSV file to RIS format."""
     try:
-        standards = load_ris_standards(standards_file)
-        fields = sorted(standards.keys())
-        
-        # Identify multi-value fields based on notes in RIS_stds.csv
-        multi_value_fields = {tag for tag, info in standards.items() 
-                            if 'each' in info['notes'].lower() and 'line' in info['notes'].lower()}
+        fields_set = frozenset(fields)
         
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            if sorted(reader.fieldnames) != fields:
-                print(f"Error: Header mismatch in {csv_file}. Expected: {fields}, Got: {reader.fieldnames}")
+        with open(csv_file, 'r', encoding='utf-8', buffering=_BUFFER_SIZE) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            if len(header) != len(fields) or frozenset(header) != fields_set:
+                print(f"Error: Header mismatch in {csv_file}. Expected: {fields}, Got: {header}")
                 return
             
-            with open(output_ris, 'w', encoding='utf-8') as ris_f:
-                for i, row in enumerate(reader, 1):
-                    if not row['TY']:
+            # Column positions of the fields to write after TY, in order, with
+            # their multi-value flag
+            idx = {name: i for i, name in enumerate(header)}
+            ty_idx = idx['TY']
+            write_plan = tuple((field, idx[field], field in multi_value_fields)
+                               for field in fields if field not in ('TY', 'ER'))
+            n_columns = len(header)
+            
+            with open(output_ris, 'w', encoding='utf-8', buffering=_BUFFER_SIZE) as ris_f:
+                i = 0
+                for row in reader:
+                    # Blank lines are not references
+                    if not row:
+                        continue
+                    i += 1
+                    if len(row) < n_columns:
+                        row += [''] * (n_columns - len(row))
+                    
+                    if not row[ty_idx]:
                         print(f"Warning: Skipping reference {i} in {csv_file} due to missing TY field")
                         continue
                     
-                    # Write TY first
-                    ris_f.write(f"TY  - {row['TY']}\n")
+                    # Collect the whole reference and write it in one call, TY first
+                    out = ["TY  - ", row[ty_idx], "\n"]
                     
-                    # Write other fields
-                    for field in fields:
-                        if field in ('TY', 'ER') or not row[field]:
+                    # Add other fields
+                    for field, column, is_multi in write_plan:
+                        field_value = row[column]
+                        if not field_value:
                             continue
                         # Handle multi-value fields
-                        if field in multi_value_fields:
-                            values = row[field].split(';')
-                            for value in values:
-                                if value.strip():
-                                    ris_f.write(f"{field}  - {value.strip()}\n")
+                        if is_multi:
+                            for value in field_value.split(';'):
+                                value = value.strip()
+                                if value:
+                                    out += (field, "  - ", value, "\n")
                         else:
-                            ris_f.write(f"{field}  - {row[field]}\n")
+                            out += (field, "  - ", field_value, "\n")
                     
-                    # Write ER to end reference
-                    ris_f.write("ER  - \n\n")
+                    # Add ER to end reference
+                    out.append("ER  - \n\n")
+                    ris_f.write(''.join(out))
         
         print(f"Converted {csv_file} to {output_ris}")
     
@@ -199,6 +323,9 @@ def main():
     merged_output_csv = '.\merged_output.csv'
     merged_output_ris = '.\merged_output.ris'
     
+    # Also drop near-duplicate references when merging (python ris2csv.py --fuzzy)
+    fuzzy_dedupe = '--fuzzy' in sys.argv[1:]
+    
     # Create output folder if it doesn't exist
     os.makedirs(csv_output_folder, exist_ok=True)
     
@@ -207,23 +334,32 @@ def main():
         print(f"Error: {standards_file} not found")
         return
     
+    # Load the standards once for every conversion step
+    try:
+        _, fields, multi_value_fields = _standards_bundle(standards_file)
+    except Exception:
+        # load_ris_standards has already reported the error
+        return
+    
     # Process each RIS file
     ris_files = glob.glob(os.path.join(ris_folder, "*.ris"))
     if not ris_files:
         print(f"No RIS files found in {ris_folder}")
         return
     
-    for ris_file in ris_files:
-        ris_filename = Path(ris_file).stem
-        output_csv = os.path.join(csv_output_folder, f"{ris_filename}.csv")
-        convert_ris_to_csv(ris_file, standards_file, output_csv)
+    output_csvs = [os.path.join(csv_output_folder, f"{Path(ris_file).stem}.csv") for ris_file in ris_files]
+    
+    # Files are independent, so convert them in parallel worker processes
+    # (Windows rejects more than 61 workers)
+    with ProcessPoolExecutor(max_workers=min(len(ris_files), os.cpu_count() or 1, 61)) as executor:
+        list(executor.map(convert_ris_to_csv, ris_files, repeat(fields), output_csvs))
     
     # Merge all CSV files
-    merge_csv_files(csv_output_folder, merged_output_csv, standards_file)
+    merge_csv_files(csv_output_folder, merged_output_csv, fields, fuzzy=fuzzy_dedupe)
     
     # Convert merged CSV to RIS
     if os.path.exists(merged_output_csv):
-        convert_csv_to_ris(merged_output_csv, standards_file, merged_output_ris)
+        convert_csv_to_ris(merged_output_csv, fields, multi_value_fields, merged_output_ris)
     else:
         print(f"Error: Merged CSV file {merged_output_csv} not found")
 